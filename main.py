@@ -1,8 +1,81 @@
 import os, sys, gc
+import cProfile
 import traceback as trace
 import numpy as np
 import pygame as pg
 
+def build_image(size, color=(0,0,0)):
+    """builds a filled sprite image, converted to the display's pixel format if a display exists
+
+    Args:
+        size (tuple): width and height of the image
+        color (tuple, optional): fill colour. Defaults to black.
+    """
+    image = pg.Surface(size)
+    if pg.display.get_surface() is not None: image = image.convert()
+    image.fill(color)
+    return image
+
+def sprite_boxes(sprites):
+    """collects the rects of the given sprites as a (K, 4) array of [left, top, right, bottom] rows
+
+    Args:
+        sprites (iterable): Sprites whose rects to collect
+    """
+    return np.array([[s.rect.left, s.rect.top, s.rect.right, s.rect.bottom] for s in sprites], np.float32).reshape(-1, 4)
+
+def collide_boxes(boxes, others):
+    """checks every box against every other box in one broadcast operation
+
+    Args:
+        boxes (np.ndarray): (N, 4) array of [left, top, right, bottom] rows, e.g. balls
+        others (np.ndarray): (K, 4) array of [left, top, right, bottom] rows, e.g. paddles
+
+    Returns:
+        np.ndarray: (N, K) boolean array, True where box n overlaps other k
+    """
+    boxes = boxes[:, None, :]
+    iw = np.minimum(boxes[..., 2], others[:, 2]) - np.maximum(boxes[..., 0], others[:, 0])
+    ih = np.minimum(boxes[..., 3], others[:, 3]) - np.maximum(boxes[..., 1], others[:, 1])
+    return (iw > 0) & (ih > 0)
+
+def _step_ball(rx, ry, vx, vy, speed, bw, bh, width, height):
+    """moves a ball by one frame, reflecting it on the window's top and bottom
+
+    Args:
+        rx, ry (float): top left corner of the ball
+        vx, vy (float): movement vector of the ball
+        speed (float): movement speed of the ball
+        bw, bh (float): width and height of the ball
+        width, height (float): window size
+
+    Returns:
+        tuple: new (rx, ry, vx, vy) and the touched goal (-1 left, 1 right, 0 none)
+    """
+    dx = vx * speed
+    dy = vy * speed
+    # Check if current movement leads ball to collide with left or right window borders.
+    # If so, one paddle has scored.
+    collided = 0
+    if rx + dx < 0: collided = -1 # BALL touched left goal
+    elif rx + bw + dx >= width: collided = 1 #ball touched right goal
+    # Check if current movement leads ball to collide with top or bottom window borders.
+    # If so, invert y projectory and update the y-position according to what distance it
+    # has travelled beyond the stepped over border.
+    if ry + dy < 0:
+        # The distance after the collision must be the overflowing distance beyond the border.
+        # I.e. the y-position of the ball after the collision on y=0 is the y-distance below 0 negated.
+        ry = -(ry + dy)
+        vy = -vy
+    elif ry + bh + dy >= height:
+        # The distance after the collision must be the overflowing distance beyond the border.
+        # I.e. the bottom of the ball after the collision on y=height is mirrored on the border.
+        ry = 2*height - (ry + bh + dy) - bh
+        vy = -vy
+    else:
+        ry += dy
+    return rx + dx, ry, vx, vy, collided
+
 class Paddle(pg.sprite.Sprite):
     """Object controlled by player (either human or AI)
     Paddle can be moved up or down, so only on the y-axis. If included, 
@@ -16,6 +89,11 @@ class Paddle(pg.sprite.Sprite):
     
     
     """    
+    # image and rect are properties of pg.sprite.Sprite, so only the attributes added here get slots
+    __slots__ = ('y_ceil', 'y_movement')
+    _SIZE = (20, 100)
+    _IMG = None # image shared by all paddles, see build_image
+
     def __init__(self, screen_height, pos: pg.math.Vector2, *groups):
         """constructor for the Paddle class
 
@@ -24,27 +102,27 @@ class Paddle(pg.sprite.Sprite):
             groups: All sprite groups to assign Paddle sprite to
         """
         super().__init__(groups)
-        self.image = pg.Surface([20, 100])
-        self.image.fill((0,0,0))
+        if Paddle._IMG is None: Paddle._IMG = build_image(Paddle._SIZE)
+        self.image = Paddle._IMG
         self.rect = self.image.get_rect()
         self.rect.center = pos
         self.y_ceil = screen_height
-        self.y_movement = 0.0
+        self.y_movement: int = 0
 
-    def move_y(self, dy=0.0):
+    def move_y(self, dy=0):
         """apply movement on y-axis for paddle
 
         Args:
-            dy (float): The y-gradient to move the paddle for. Defaults to 0.0. 
+            dy (int): The y-gradient to move the paddle for, rounded to whole pixels. Defaults to 0. 
         """
-        self.y_movement = dy
+        self.y_movement = round(dy)
 
     def update(self):
         """update function of ball sprite, applied every frame of the pygame
         """
         self.rect.y += self.y_movement
         if self.rect.top > self.y_ceil: self.rect.top = self.y_ceil
-        if self.rect.bottom < 0.0: self.rect.bottom = 0.0
+        if self.rect.bottom < 0: self.rect.bottom = 0
         
 
 class Ball(pg.sprite.Sprite):
@@ -57,6 +135,10 @@ class Ball(pg.sprite.Sprite):
     has been collided with. This determines the winner of the current round.
     
     """    
+    __slots__ = ('paddles', '_w', '_h', 'init_pos', 'speed', 'vx', 'vy', 'x_collided')
+    _SIZE = (20, 20)
+    _IMG = None # image shared by all balls, see build_image
+
     def __init__(self, paddles : pg.sprite.Group, screen_size : pg.math.Vector2, init_pos : pg.math.Vector2, speed: float=1., *groups):
         """constructor for the Ball class
 
@@ -69,50 +151,45 @@ class Ball(pg.sprite.Sprite):
         """
         super().__init__(groups)
         self.paddles = paddles
-        self.borders = screen_size
-        self.image = pg.Surface([20, 20])
-        self.image.fill((0,0,0))
-        self.rect = self.image.get_rect()
-        self.rect.center = init_pos
+        self._w, self._h = int(screen_size[0]), int(screen_size[1]) # window borders, unpacked once
+        if Ball._IMG is None: Ball._IMG = build_image(Ball._SIZE)
+        self.image = Ball._IMG
+        self.rect = self.image.get_frect() # float rect, keeps sub-pixel positions between frames
+        self.init_pos = (init_pos[0], init_pos[1])
+        self.rect.center = self.init_pos
         self.speed = speed
-        self.movement_vec = pg.math.Vector2(1.,4.) # Movement vector where the ball initially moves towards
+        self.vx, self.vy = 1.0, 4.0 # Movement vector where the ball initially moves towards, kept as plain floats
         self.x_collided = 0  #can take values 0, 1 or -1 meaning playing = 0, touched left goal = -1, touched right goal = 1
 
     def score(self):
         return self.x_collided
+
+    def reset(self):
+        """starts a new round: teleports the ball back to its initial position and clears the scored goal
+        """
+        self.rect.center = self.init_pos
+        self.x_collided = 0
     
     def update(self):
         """update function of ball sprite, applied every frame of the pygame
         """
-        width, height = self.borders
-        paddles = self.paddles 
-        dx, dy = self.movement_vec * self.speed
-        # obsolete? (new_ball_pos = self.rect.center + self.movement_vec)
-        # Check if current movement leads ball to collide with left or right window borders.
-        # If so, one paddle has scored.
-        if self.rect.left + dx < 0: self.x_collided = -1 # BALL touched left goal
-        elif self.rect.right + dx >= width: self.x_collided = 1 #ball touched right goal
-        # Check if current movement leads ball to collide with left or right window borders.
-        # If so, invert y projectory and update the y-position according to what distance it
-        # has travelled beyond the stepped over border.
-        if self.rect.top + dy < 0: 
-            print("Top", self.rect.top)
-            # The distance after the collision must be the overflowing distance beyond the border.
-            # I.e. the y-position of the ball after the collision on y=0 is the y-distance below 0 negated.
-            # (total y-distance = rect.center[1] [-> distance until y=0] + (movement_vec[1] - rect.center[1]) [-> distance after y=0]) 
-            dist_after_coll = -(self.rect.top + dy) 
-            self.rect.top = dist_after_coll
-            self.movement_vec[1] *= -1
-        elif self.rect.bottom + dy >= height: 
-            print("Butt", self.rect.bottom)
-            # The distance after the collision must be the overflowing distance beyond the border.
-            # I.e. the y-position of the ball after the collision on y=height is difference between the height and the new center y-position.
-            # (total y-distance = (height - rect.center[1]) [-> distance until y=0] + (movement_vec[1] - height) [-> distance after y=0])
-            dist_after_coll = 2*height - (self.rect.bottom + dy)
-            self.rect.bottom = dist_after_coll
-            self.movement_vec[1] *= -1
-
-        self.rect.center += self.movement_vec
+        # Hoist attribute lookups into locals, they are written back once at the end
+        rect = self.rect
+        vx, vy, s = self.vx, self.vy, self.speed
+        x, y, w, h = rect.x, rect.y, rect.width, rect.height
+        dx = vx * s
+        dy = vy * s
+        # Check if current movement leads ball into a paddle it is moving towards.
+        # If so, invert x projectory so it heads to the other paddle.
+        # (plain rect checks, for a single ball they are cheaper than collide_boxes)
+        moved = rect.move(dx, dy)
+        for paddle in self.paddles:
+            if moved.colliderect(paddle.rect) and (paddle.rect.centerx - moved.centerx) * dx > 0:
+                vx = -vx
+                break
+        x, y, self.vx, self.vy, collided = _step_ball(x, y, vx, vy, s, w, h, self._w, self._h)
+        rect.topleft = (x, y)
+        if collided: self.x_collided = collided
         #-----
         #|   |
         #| x |
@@ -120,6 +197,95 @@ class Ball(pg.sprite.Sprite):
         #-----
 
 
+class BatchBalls:
+    """Many balls simulated at once, e.g. for parallel ai training environments.
+    Instead of one Ball sprite per ball, positions and movement vectors of all balls
+    are stored as (N, 2) arrays and updated with one vectorized step per frame. The
+    rules are the same as for Ball: the y-movement is inverted on the window's top and
+    bottom, and x_collided marks which goal each ball has touched.
+    Sprites passed to the constructor's groups are only views, their rects are
+    overwritten with the array positions after every update.
+    """
+    def __init__(self, n : int, screen_size : pg.math.Vector2, init_pos : pg.math.Vector2, speed: float=1., *groups):
+        """constructor for the BatchBalls class
+
+        Args:
+            n (int): Number of balls
+            screen_size (pg.math.Vector2): Window screen width and height for window border collision
+            init_pos (pg.math.Vector2): Initial position of the balls' centres
+            speed (float, optional): Movement speed of the balls. Defaults to 1..
+            groups(list): Sprite groups to assign the balls' view sprites to, if any
+        """
+        self.width, self.height = float(screen_size[0]), float(screen_size[1])
+        self.size = np.array(Ball._SIZE, np.float32)
+        self.speed = speed
+        self.init_pos = np.array(init_pos, np.float32) - self.size / 2 # initial top left corner, see reset
+        self.pos = np.zeros((n, 2), np.float32) # top left corner of every ball
+        self.pos[:] = self.init_pos
+        self.vel = np.zeros((n, 2), np.float32)
+        self.vel[:] = (1., 4.) # Movement vector where the balls initially move towards
+        self.x_collided = np.zeros(n, np.int8) # same values as Ball.x_collided, per ball
+        self.sprites = []
+        self._image = None # Ball._IMG the view sprites use, see sync_sprites
+        if groups:
+            if Ball._IMG is None: Ball._IMG = build_image(Ball._SIZE)
+            self._image = Ball._IMG
+            for _ in range(n):
+                sprite = pg.sprite.Sprite(groups)
+                sprite.image = Ball._IMG
+                sprite.rect = sprite.image.get_frect()
+                self.sprites.append(sprite)
+            self.sync_sprites()
+
+    def update(self, paddle_boxes=None):
+        """advances all balls by one frame
+
+        Args:
+            paddle_boxes (np.ndarray, optional): (K, 4) paddle boxes as built by sprite_boxes to reflect the balls on
+        """
+        pos = self.pos + self.vel * self.speed
+        if paddle_boxes is not None and len(paddle_boxes):
+            # Same paddle reflection as Ball.update (towards is judged from the moved centre), for all balls and paddles at once
+            hit = collide_boxes(np.concatenate([pos, pos + self.size], axis=1), paddle_boxes)
+            towards = ((paddle_boxes[:, 0] + paddle_boxes[:, 2]) / 2 - (pos[:, 0, None] + self.size[0] / 2)) * self.vel[:, 0, None] > 0
+            reflect = np.any(hit & towards, axis=1)
+            self.vel[:, 0] = np.where(reflect, -self.vel[:, 0], self.vel[:, 0])
+            pos = self.pos + self.vel * self.speed
+        x, y = pos[:, 0], pos[:, 1]
+        w, h = self.size
+        self.x_collided[x < 0] = -1 # ball touched left goal
+        self.x_collided[x + w >= self.width] = 1 # ball touched right goal
+        # Reflect the overflowing distance back into the window, like Ball.update does
+        top = y < 0
+        bottom = y + h >= self.height
+        y[:] = np.where(top, -y, y)
+        y[:] = np.where(bottom, 2*self.height - 2*h - y, y)
+        self.vel[:, 1] = np.where(top | bottom, -self.vel[:, 1], self.vel[:, 1])
+        self.pos = pos
+        if self.sprites: self.sync_sprites()
+
+    def reset(self, mask=None):
+        """starts a new round for the given balls, like Ball.reset: teleports them back to
+        their initial position and clears their scored goal
+
+        Args:
+            mask (np.ndarray, optional): (N,) boolean array selecting the balls to reset, e.g. x_collided != 0. Defaults to all balls.
+        """
+        if mask is None: mask = slice(None)
+        self.pos[mask] = self.init_pos
+        self.x_collided[mask] = 0
+        if self.sprites: self.sync_sprites()
+
+    def sync_sprites(self):
+        """copies the array positions back to the view sprites' rects
+        """
+        if self._image is not Ball._IMG: # rebuilt in the display format since the views were made, e.g. by the engine
+            self._image = Ball._IMG
+            for sprite in self.sprites: sprite.image = Ball._IMG
+        for sprite, (x, y) in zip(self.sprites, self.pos.tolist()):
+            sprite.rect.topleft = (x, y)
+
+
 class Engine:
     def __init__(self, ball : Ball, paddles : pg.sprite.Group, print_debug=False):
         self.__print_debug = print_debug
@@ -128,21 +294,34 @@ class Engine:
         self.__playing = False
         self.__screen_size = (1280, 720)
         self.__fps = 60
+        self.__step_ms = 1000 // self.__fps # fixed duration of one update step, whole ms like Clock.tick returns
+        self.__max_steps = 5 # most update steps to catch up on per frame, any further backlog is skipped
         self.__master_volume = 100
         self.__sound_volume = 100
         self.__music_volume = 100
         #self.read_options_file()
 
         pg.init()
+        if print_debug and not getattr(pg, "IS_CE", False): print("\rWarning: running on upstream pygame, pygame-ce is expected")
         self.__screen = pg.display.set_mode(self.__screen_size)
+        # Only let SDL queue the events handled in events()
+        pg.event.set_blocked(None)
+        pg.event.set_allowed([pg.QUIT, pg.KEYDOWN])
+        # Sprites may have been built before the display existed, rebuild their images in the display format
+        Paddle._IMG = build_image(Paddle._SIZE)
+        Ball._IMG = build_image(Ball._SIZE)
         self.__mouse_pos = pg.mouse.get_pos()
         self.__clock = pg.time.Clock()
-        self.__dt = self.__clock.tick(self.__fps) / 1000
+        self.__accum = 0.0 # time not yet simulated, in ms
         self.__ball = ball
-        self.__paddles = paddles
-        self.__sprites = paddles.copy()
-        self.__sprites.add(ball)
-        pg.key.set_repeat(int(self.__dt * 1000))
+        # One group for update and draw, paddles are added first so they update before the ball
+        self.__sprites = pg.sprite.RenderUpdates()
+        self.__sprites.add(*paddles, ball)
+        for sprite in self.__sprites:
+            if isinstance(sprite, (Paddle, Ball)): sprite.image = type(sprite)._IMG
+        self.__background = build_image(self.__screen_size, (10,100,10))
+        self.__screen.blit(self.__background, (0, 0))
+        pg.display.flip()
         pg.display.set_caption("engine")
         self.__playing = True
         if print_debug: print("\rBuilding successful!")
@@ -150,7 +329,6 @@ class Engine:
     def __quit(self):
         if self.__print_debug: print("Closing engine")
         pg.quit()
-        sys.exit()
 
     def get_screen_size(self):
         return self.__screen_size
@@ -159,9 +337,10 @@ class Engine:
         self.__sprites.add(new_sprite)
         
     def draw(self):
-        self.__screen.fill((10,100,10))
-        self.__sprites.draw(self.__screen)
-        pg.display.flip()
+        # Only repaint and push the areas the sprites covered last frame and cover now
+        self.__sprites.clear(self.__screen, self.__background)
+        dirty = self.__sprites.draw(self.__screen)
+        pg.display.update(dirty)
 
         """
         Updates the game state after each frame transpires  
@@ -169,11 +348,12 @@ class Engine:
     def update(self):
         #to be called every frame of the game
         if self.__state_id == 0: # Playing state
-            self.__paddles.update()
-            self.__ball.update()
-            if self.__ball.score != 0: self.__state_id = 1
+            self.__sprites.update()
+            if self.__ball.x_collided: self.__state_id = 1 # a goal has been scored
         elif self.__state_id == 1: # Evaluation phase for ai agent
             # Let ai update itself, something, blabla
+            gc.collect() # the game is paused between rounds anyway, so a collection stall goes unnoticed
+            self.__ball.reset() # next round
             self.__state_id = 0
 
     def events(self):
@@ -188,15 +368,26 @@ class Engine:
         
     def run(self):
         if self.__print_debug: print("Engine running...")
-        while self.__playing:
-            try:
-                self.__dt = self.__clock.tick(self.__fps) / 1000
-                self.events()
-                self.update()
-                self.draw()
-            except Exception:
-                trace.print_exc()
-                self.__playing = False
+        self.__clock.tick()
+        gc.disable() # no automatic collections mid-round, see the evaluation phase in update
+        try:
+            while self.__playing:
+                try:
+                    # Run the game logic in fixed steps, independent of how long each frame took
+                    self.__accum += self.__clock.tick(self.__fps)
+                    self.events()
+                    steps = 0
+                    while self.__accum >= self.__step_ms and steps < self.__max_steps:
+                        self.update()
+                        self.__accum -= self.__step_ms
+                        steps += 1
+                    if self.__accum >= self.__step_ms: self.__accum = 0.0 # still too far behind, skip instead of spiralling
+                    self.draw()
+                except Exception:
+                    trace.print_exc()
+                    self.__playing = False
+        finally:
+            gc.enable()
         self.__quit()
 
 def main():
@@ -205,7 +396,9 @@ def main():
     paddleR = Paddle(720, pg.math.Vector2(1280, 360), paddles)
     ball = Ball(paddles, pg.math.Vector2(1280, 720), pg.math.Vector2(640, 360))
     pong = Engine(ball, paddles, True)
-    while True:
+    if "--profile" in sys.argv: # inspect with e.g. `snakeviz pong.prof`
+        cProfile.runctx("pong.run()", globals(), locals(), "pong.prof")
+    else:
         pong.run()
                
 if __name__ == "__main__":  